@@ -8,13 +8,14 @@ Repository: https://github.com/MyCato/Tpublish
 """
 
 import asyncio
+import glob
 import json
 import os
 import random
 import sys
 import time
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional
 
 from telethon import TelegramClient
 from telethon.errors import (
@@ -22,27 +23,59 @@ from telethon.errors import (
     ChatAdminRequiredError, 
     ChatWriteForbiddenError,
     UserBannedInChannelError,
-    SlowModeWaitError
+    SlowModeWaitError,
+    PeerIdInvalidError,
+    ChannelInvalidError
 )
 from telethon.tl.types import Chat, Channel
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def write_json_atomic(path: str, data) -> None:
+    """Write compact JSON to a temp file and swap it in, so a crash never leaves a partial file"""
+    if orjson is not None:
+        # last_sent is keyed by integer chat IDs
+        blob = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        blob = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+            # Make sure the data is on disk before the rename makes it visible
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _list_sessions() -> List[str]:
+    """List existing session files in the current directory"""
+    return sorted(glob.glob('*.session'))
+
 def get_session_file_path(force_mode: bool = False) -> str:
     """Get session file path from user input or auto-detect in force mode"""
     
+    # Check for existing session files in current directory
+    session_files = _list_sessions()
+    # Telethon takes the session name without the .session extension
+    session_stems = [file[:-8] for file in session_files]
+    
     if force_mode:
         print("🚀 Force mode enabled - auto-detecting session file...")
         
-        # Check for existing session files in current directory
-        session_files = []
-        for file in os.listdir('.'):
-            if file.endswith('.session'):
-                session_files.append(file)
-        
         if session_files:
             # Use the first session file found
-            selected_file = session_files[0][:-8]  # Remove .session extension
             print(f"✅ Using existing session: {session_files[0]}")
-            return selected_file
+            return session_stems[0]
         else:
             print("⚠️  No existing session files found in force mode.")
             print("📝 Will create new session: publisher_session.session")
@@ -51,12 +84,6 @@ def get_session_file_path(force_mode: bool = False) -> str:
     print("\n📁 Session File Selection")
     print("=" * 30)
     
-    # Check for existing session files in current directory
-    session_files = []
-    for file in os.listdir('.'):
-        if file.endswith('.session'):
-            session_files.append(file)
-    
     if session_files:
         print("Found existing session files:")
         for i, file in enumerate(session_files, 1):
@@ -70,8 +97,7 @@ def get_session_file_path(force_mode: bool = False) -> str:
                 choice_num = int(choice)
                 
                 if 1 <= choice_num <= len(session_files):
-                    # Remove .session extension for Telethon
-                    return session_files[choice_num - 1][:-8]
+                    return session_stems[choice_num - 1]
                 elif choice_num == len(session_files) + 1:
                     # Custom path
                     break
@@ -128,26 +154,68 @@ class TelethonPublisher:
         self.groups_file = 'groups.json'
         self.config_file = 'config.json'
         self.groups = self.load_groups()
+        self._groups_by_id: Dict[int, int] = {}
+        self._rebuild_group_index()
+        self._today: Optional[str] = None
+        self._today_ts: float = 0.0
+        self._config_dirty = False
+        self._config_mtime = 0.0
+        self.config: Optional[Dict] = None
         self.config = self.load_config()
+        # Token bucket shared by all sends (Telegram allows ~30 messages/sec).
+        # 'rate' and 'cap' shrink on flood waits and grow back up to 'max'.
+        self._bucket = {'tokens': 25.0, 'last': time.monotonic(), 'rate': 25.0, 'cap': 25.0,
+                        'max': 25.0, 'streak': 0}
+        # Resolved InputPeer for each group, so sends skip entity lookups
+        self._peers: Dict[int, Any] = {}
+        # Menu option -> handler ("Back"/"Exit" are handled by the menu loops)
+        self._edit_menu = {
+            '1': self.set_message_count,
+            '2': self.edit_messages,
+            '3': self.set_delays,
+            '4': self.set_daily_limit,
+        }
+        self._main_menu = {
+            '1': self.start_publishing,
+            '2': self.add_group,
+            '3': self.remove_group,
+            '4': self.edit_text_and_delays,
+        }
         
     def load_groups(self) -> List[Dict]:
         """Load groups from JSON file"""
         if os.path.exists(self.groups_file):
             try:
                 with open(self.groups_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                    groups = json.load(f)
             except Exception as e:
                 print(f"Error loading groups: {e}")
+                return []
+            
+            # Older groups files store chat IDs as strings
+            valid_groups = []
+            for group in groups:
+                try:
+                    group['chat_id'] = int(group['chat_id'])
+                except (KeyError, TypeError, ValueError):
+                    print(f"⚠️  Skipping group with invalid chat ID: {group}")
+                    print(f"   It will be removed from {self.groups_file} the next time groups are saved")
+                    continue
+                valid_groups.append(group)
+            return valid_groups
         return []
     
     def save_groups(self):
         """Save groups to JSON file"""
         try:
-            with open(self.groups_file, 'w', encoding='utf-8') as f:
-                json.dump(self.groups, f, indent=2, ensure_ascii=False)
+            write_json_atomic(self.groups_file, self.groups)
         except Exception as e:
             print(f"Error saving groups: {e}")
     
+    def _rebuild_group_index(self):
+        """Rebuild the chat ID -> list index lookup for groups"""
+        self._groups_by_id = {group['chat_id']: i for i, group in enumerate(self.groups)}
+    
     def load_config(self) -> Dict:
         """Load configuration from JSON file"""
         default_config = {
@@ -156,29 +224,100 @@ class TelethonPublisher:
             "min_delay": 10,  # Minimum delay between groups (anti-ban)
             "max_delay": 60,  # Maximum delay between groups (anti-ban)
             "daily_limit": 50,  # Maximum messages per day per group
-            "last_sent": {}  # Track last sent time for each group
+            "last_sent": {}  # Today's send count for each group: {chat_id: {"date", "count"}}
         }
         
         if os.path.exists(self.config_file):
             try:
+                # Skip parsing the file again if it hasn't changed since we last read or wrote it
+                mtime = os.stat(self.config_file).st_mtime
+                if self.config is not None and mtime == self._config_mtime:
+                    return self.config
+                
                 with open(self.config_file, 'r', encoding='utf-8') as f:
                     loaded_config = json.load(f)
                     # Merge with defaults to ensure all keys exist
                     default_config.update(loaded_config)
+                self._config_mtime = mtime
+                default_config["last_sent"] = self._migrate_last_sent(default_config["last_sent"])
+                self._gc_last_sent(default_config["last_sent"], self._today_key())
             except Exception as e:
                 print(f"Error loading config: {e}")
+                # On a reload, keep running with the config we already have
+                if self.config is not None:
+                    print("📝 Keeping the current configuration")
+                    return self.config
         
         return default_config
     
+    def _migrate_last_sent(self, last_sent: Dict) -> Dict:
+        """Key send counters by integer chat ID, converting old "{chat_id}_{date}" counters"""
+        migrated = {}
+        for key, value in last_sent.items():
+            try:
+                if isinstance(value, dict):
+                    # JSON object keys are always strings
+                    migrated[int(key)] = value
+                    continue
+                
+                # Old format: keep only the most recent day for each group
+                raw_id, _, date = key.rpartition('_')
+                chat_id = int(raw_id)
+            except ValueError:
+                continue
+            
+            entry = migrated.get(chat_id)
+            if entry is None or entry['date'] < date:
+                migrated[chat_id] = {'date': date, 'count': value}
+        
+        return migrated
+    
+    def _gc_last_sent(self, last_sent: Dict, today: str) -> bool:
+        """Drop send counters left over from previous days, returning whether any were dropped"""
+        stale = [chat_id for chat_id, entry in last_sent.items() if entry['date'] != today]
+        for chat_id in stale:
+            del last_sent[chat_id]
+        
+        return bool(stale)
+    
+    def reload_config(self):
+        """Pick up hand edits to the config file made while the bot is running"""
+        # Unsaved send counters would be lost by reloading
+        if not self._config_dirty:
+            self.config = self.load_config()
+    
     def save_config(self):
         """Save configuration to JSON file"""
+        if self._write_config(self.config):
+            self._config_dirty = False
+    
+    async def asave_config(self):
+        """Save configuration from a worker thread so sends keep running"""
+        # Snapshot the counters so the event loop can keep updating them
+        last_sent = {chat_id: dict(entry) for chat_id, entry in self.config['last_sent'].items()}
+        snapshot = dict(self.config, last_sent=last_sent)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write_config, snapshot)
+    
+    def _write_config(self, config: Dict) -> bool:
+        """Write a configuration dict to the JSON file, returning whether it succeeded"""
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, indent=2, ensure_ascii=False)
+            write_json_atomic(self.config_file, config)
+            self._config_mtime = os.stat(self.config_file).st_mtime
+            return True
         except Exception as e:
             print(f"Error saving config: {e}")
+            return False
+    
+    def _today_key(self) -> str:
+        """Get today's date string, recomputed at most once a minute"""
+        now = time.time()
+        if self._today is None or now - self._today_ts >= 60:
+            self._today = datetime.now().strftime('%Y-%m-%d')
+            self._today_ts = now
+        return self._today
     
-    def can_send_to_group(self, chat_id: str) -> bool:
+    def can_send_to_group(self, chat_id: int) -> bool:
         """Check if we can send to a group today (rate limiting)"""
         # In force mode, be more lenient with rate limits
         if self.force_mode:
@@ -187,29 +326,81 @@ class TelethonPublisher:
         else:
             effective_limit = self.config["daily_limit"]
         
-        today = datetime.now().strftime('%Y-%m-%d')
-        key = f"{chat_id}_{today}"
-        
-        if key not in self.config["last_sent"]:
-            self.config["last_sent"][key] = 0
+        entry = self.config["last_sent"].get(chat_id)
+        if entry is None or entry['date'] != self._today_key():
+            return True
         
-        return self.config["last_sent"][key] < effective_limit
+        return entry['count'] < effective_limit
     
-    def mark_sent_to_group(self, chat_id: str):
+    def mark_sent_to_group(self, chat_id: int):
         """Mark that we sent a message to a group"""
-        today = datetime.now().strftime('%Y-%m-%d')
-        key = f"{chat_id}_{today}"
+        today = self._today_key()
+        entry = self.config["last_sent"].setdefault(chat_id, {'date': today, 'count': 0})
         
-        if key not in self.config["last_sent"]:
-            self.config["last_sent"][key] = 0
+        # Start counting again on a new day
+        if entry['date'] != today:
+            entry.update(date=today, count=0)
         
-        self.config["last_sent"][key] += 1
-        self.save_config()
+        entry['count'] += 1
+        # Written out in one go by flush_config() once the batch finishes
+        self._config_dirty = True
+    
+    async def flush_config(self):
+        """Save configuration if send counters changed since the last save"""
+        if self._config_dirty:
+            self._config_dirty = False
+            await self.asave_config()
+    
+    async def _acquire(self):
+        """Wait until the rate limiter allows another message to be sent"""
+        bucket = self._bucket
+        while True:
+            now = time.monotonic()
+            bucket['tokens'] = min(bucket['cap'], bucket['tokens'] + (now - bucket['last']) * bucket['rate'])
+            bucket['last'] = now
+            
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return
+            
+            await asyncio.sleep((1 - bucket['tokens']) / bucket['rate'])
+    
+    def _rate_backoff(self):
+        """Slow down the send rate and burst size after a flood wait"""
+        bucket = self._bucket
+        bucket['tokens'] = 0.0
+        bucket['rate'] = max(0.5, bucket['rate'] * 0.5)
+        bucket['cap'] = max(1.0, bucket['cap'] * 0.5)
+        bucket['streak'] = 0
+    
+    def _rate_recover(self):
+        """Double the send rate again after a run of successful sends"""
+        bucket = self._bucket
+        bucket['streak'] += 1
+        if bucket['streak'] >= 50 and bucket['rate'] < bucket['max']:
+            bucket['rate'] = min(bucket['max'], bucket['rate'] * 2)
+            bucket['cap'] = min(bucket['max'], bucket['cap'] * 2)
+            bucket['streak'] = 0
+    
+    async def _get_peer(self, chat_id: int):
+        """Get the cached InputPeer for a group, resolving it if needed"""
+        peer = self._peers.get(chat_id)
+        if peer is None:
+            peer = await self.client.get_input_entity(chat_id)
+            self._peers[chat_id] = peer
+        return peer
     
     async def start_client(self):
         """Start the Telethon client"""
         await self.client.start(phone=self.phone)
         print("✅ Successfully connected to Telegram")
+        
+        # Resolve all groups up front so publishing doesn't have to
+        for group in self.groups:
+            try:
+                await self._get_peer(group['chat_id'])
+            except Exception as e:
+                print(f"⚠️  Could not resolve group {group['name']}: {e}")
     
     async def add_group(self):
         """Add a group by chat ID"""
@@ -234,17 +425,17 @@ class TelethonPublisher:
                 group_name = entity.title
                 
                 # Check if already exists
-                for group in self.groups:
-                    if group['chat_id'] == chat_id:
-                        print(f"❌ Group '{group_name}' is already in the list")
-                        return
+                if chat_id_int in self._groups_by_id:
+                    print(f"❌ Group '{group_name}' is already in the list")
+                    return
                 
                 # Add the group
                 self.groups.append({
-                    'chat_id': chat_id,
+                    'chat_id': chat_id_int,
                     'name': group_name,
                     'added_date': datetime.now().isoformat()
                 })
+                self._groups_by_id[chat_id_int] = len(self.groups) - 1
                 
                 self.save_groups()
                 print(f"✅ Successfully added group: {group_name}")
@@ -279,19 +470,25 @@ class TelethonPublisher:
                 index = int(choice) - 1
                 if 0 <= index < len(self.groups):
                     removed_group = self.groups.pop(index)
+                    self._peers.pop(removed_group['chat_id'], None)
+                    # Indices after the removed group shift down by one
+                    self._rebuild_group_index()
                     self.save_groups()
                     print(f"✅ Removed group: {removed_group['name']}")
                 else:
                     print("❌ Invalid group number")
             else:
                 # Treat as chat ID
-                for i, group in enumerate(self.groups):
-                    if group['chat_id'] == choice:
-                        removed_group = self.groups.pop(i)
-                        self.save_groups()
-                        print(f"✅ Removed group: {removed_group['name']}")
-                        return
-                print("❌ Group with that chat ID not found")
+                index = self._groups_by_id.get(int(choice))
+                if index is None:
+                    print("❌ Group with that chat ID not found")
+                    return
+                
+                removed_group = self.groups.pop(index)
+                self._peers.pop(removed_group['chat_id'], None)
+                self._rebuild_group_index()
+                self.save_groups()
+                print(f"✅ Removed group: {removed_group['name']}")
                 
         except ValueError:
             print("❌ Invalid input")
@@ -320,16 +517,12 @@ class TelethonPublisher:
             
             choice = input("Choose option: ").strip()
             
-            if choice == '1':
-                self.set_message_count()
-            elif choice == '2':
-                self.edit_messages()
-            elif choice == '3':
-                self.set_delays()
-            elif choice == '4':
-                self.set_daily_limit()
-            elif choice == '5':
+            if choice == '5':
                 break
+            
+            handler = self._edit_menu.get(choice)
+            if handler:
+                handler()
             else:
                 print("❌ Invalid choice")
     
@@ -437,26 +630,39 @@ class TelethonPublisher:
         except ValueError:
             print("❌ Please enter a valid number")
     
-    async def send_message_safely(self, chat_id: str, message: str) -> bool:
+    async def prepare_message(self, message: str):
+        """Parse message formatting once so every group reuses the result"""
+        try:
+            # Uses the client's default parse mode, same as send_message()
+            return await self.client._parse_message_text(message, ())
+        except Exception:
+            # Let send_message() parse it itself
+            return message, None
+    
+    async def send_message_safely(self, chat_id: int, message: str, entities: Optional[List] = None) -> bool:
         """Send a message with error handling and security measures"""
         try:
-            chat_id_int = int(chat_id)
-            
             # Check rate limits
             if not self.can_send_to_group(chat_id):
                 print(f"⚠️  Daily limit reached for group {chat_id}")
                 return False
             
             # Send the message
-            await self.client.send_message(chat_id_int, message)
+            await self._acquire()
+            peer = await self._get_peer(chat_id)
+            await self.client.send_message(peer, message, formatting_entities=entities)
             
             # Mark as sent
             self.mark_sent_to_group(chat_id)
             
+            self._rate_recover()
+            
             return True
             
         except FloodWaitError as e:
             print(f"⚠️  Flood wait error: need to wait {e.seconds} seconds")
+            # Back off the send rate for everyone sharing the bucket
+            self._rate_backoff()
             await asyncio.sleep(e.seconds)
             return False
             
@@ -465,6 +671,12 @@ class TelethonPublisher:
             await asyncio.sleep(e.seconds)
             return False
             
+        except (PeerIdInvalidError, ChannelInvalidError):
+            # Cached peer is no longer valid, resolve it again on the next send
+            self._peers.pop(chat_id, None)
+            print(f"❌ Group {chat_id} is no longer reachable, will retry lookup next time")
+            return False
+            
         except ChatWriteForbiddenError:
             print(f"❌ Can't write to group {chat_id} (no permission)")
             return False
@@ -491,6 +703,9 @@ class TelethonPublisher:
             print("❌ No messages configured. Please edit messages first.")
             return
         
+        if self._gc_last_sent(self.config['last_sent'], self._today_key()):
+            self._config_dirty = True
+        
         if not self.force_mode:
             print(f"\n🚀 Starting to publish {len(self.config['messages'])} message(s) to {len(self.groups)} group(s)")
             print("Press Ctrl+C to stop at any time")
@@ -505,6 +720,11 @@ class TelethonPublisher:
                 print("❌ Publishing cancelled")
                 return
         
+        # Group peers are already cached in memory, so don't have every
+        # concurrent send write the entities it sees to the SQLite session
+        save_entities = self.client.session.save_entities
+        self.client.session.save_entities = False
+        
         try:
             total_sent = 0
             
@@ -520,28 +740,32 @@ class TelethonPublisher:
                 await asyncio.sleep(delay)
                 
                 print(f"📤 Sending message {message_index + 1} to all groups...")
+                text, entities = await self.prepare_message(message)
                 
-                # Create tasks for all groups for this message
-                tasks = []
+                # Only groups still under their daily limit get this message
+                eligible = [group for group in self.groups if self.can_send_to_group(group['chat_id'])]
+                eligible_ids = {group['chat_id'] for group in eligible}
                 for group in self.groups:
-                    chat_id = group['chat_id']
-                    group_name = group['name']
-                    
-                    # Check if we can send to this group
-                    if not self.can_send_to_group(chat_id):
-                        print(f"⚠️  Skipping {group_name} - daily limit reached")
-                        continue
-                    
-                    # Create a task for this group with a small delay
-                    task = self.send_to_group_with_delay(chat_id, group_name, message, len(tasks) * 2)  # 2 seconds between each group
-                    tasks.append(task)
+                    if group['chat_id'] not in eligible_ids:
+                        print(f"⚠️  Skipping {group['name']} - daily limit reached")
+                
+                # Spacing between groups is handled by the rate limiter
+                tasks = [
+                    self.send_to_group(group['chat_id'], group['name'], text, entities)
+                    for group in eligible
+                ]
                 
-                # Wait for all tasks to complete
                 if tasks:
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                    # Count successful sends as they finish
+                    successful_sends = 0
+                    for future in asyncio.as_completed(tasks):
+                        try:
+                            if await future is True:
+                                successful_sends += 1
+                        except Exception:
+                            pass
                     
-                    # Count successful sends
-                    successful_sends = sum(1 for result in results if result is True)
+                    await self.flush_config()
                     total_sent += successful_sends
                     
                     print(f"✅ Message {message_index + 1} sent to {successful_sends}/{len(tasks)} groups")
@@ -552,15 +776,14 @@ class TelethonPublisher:
             print("\n⏹️  Publishing stopped by user")
         except Exception as e:
             print(f"\n❌ Error during publishing: {e}")
+        finally:
+            self.client.session.save_entities = save_entities
+            await self.flush_config()
     
-    async def send_to_group_with_delay(self, chat_id: str, group_name: str, message: str, delay: int) -> bool:
-        """Send message to a group with a small delay"""
+    async def send_to_group(self, chat_id: int, group_name: str, message: str, entities: Optional[List] = None) -> bool:
+        """Send message to a group, waiting for the rate limiter"""
         try:
-            # Small delay to avoid hitting rate limits
-            if delay > 0:
-                await asyncio.sleep(delay)
-            
-            success = await self.send_message_safely(chat_id, message)
+            success = await self.send_message_safely(chat_id, message, entities)
             
             if success:
                 print(f"✅ Sent to {group_name}")
@@ -617,7 +840,7 @@ class TelethonPublisher:
             print(f"  Groups: {len(self.groups)}")
             print(f"  Messages: {len(self.config['messages'])}")
             print(f"  Publishing interval: 30 seconds")
-            print(f"  Light delay between groups: 2 seconds each")
+            print(f"  Rate limit: {self._bucket['max']:.0f} messages/second")
             
             cycle_count = 0
             try:
@@ -625,6 +848,7 @@ class TelethonPublisher:
                     cycle_count += 1
                     print(f"\n🔄 Publishing cycle #{cycle_count} started at {datetime.now().strftime('%H:%M:%S')}")
                     
+                    self.reload_config()
                     await self.start_publishing()
                     
                     print(f"⏱️  Waiting 30 seconds before next cycle...")
@@ -639,6 +863,7 @@ class TelethonPublisher:
                 print("🤖 TELETHON PUBLISHER BOT")
                 print("=" * 50)
                 
+                self.reload_config()
                 self.show_status()
                 
                 print("\n📋 Main Menu:")
@@ -650,17 +875,16 @@ class TelethonPublisher:
                 
                 choice = input("\nChoose option (1-5): ").strip()
                 
-                if choice == '1':
-                    await self.start_publishing()
-                elif choice == '2':
-                    await self.add_group()
-                elif choice == '3':
-                    await self.remove_group()
-                elif choice == '4':
-                    self.edit_text_and_delays()
-                elif choice == '5':
+                if choice == '5':
                     print("👋 Goodbye!")
                     break
+                
+                handler = self._main_menu.get(choice)
+                if handler:
+                    result = handler()
+                    # Some menu actions are coroutines, others are plain methods
+                    if asyncio.iscoroutine(result):
+                        await result
                 else:
                     print("❌ Invalid choice. Please select 1-5.")
         